@@ -1,5 +1,5 @@
 # core/admin_dashboard_views.py
-from datetime import date, timedelta, datetime
+from datetime import date, timedelta
 from django.contrib.admin.views.decorators import staff_member_required
 from django.shortcuts import render
 from django.http import Http404
@@ -311,7 +311,7 @@ def calculate_weekly_summaries(participant):
     
     for i, target_date_str in enumerate(target_dates):
         target_data = targets[target_date_str]
-        target_date = datetime.strptime(target_date_str, '%Y-%m-%d').date()
+        target_date = date.fromisoformat(target_date_str)
         
         # Calculate the week that this target represents (week ending on target_date - 1)
         week_end = target_date - timedelta(days=1)
@@ -1,10 +1,12 @@
 # core/management/commands/calculate_weekly_targets.py
+from django.conf import settings
+from django.core.mail import get_connection
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import date, timedelta
 from core.models import Participant
 from goals.targets import run_weekly_algorithm, is_target_day, _log_status_flag
-from goals.notifications import send_goal_notification, create_message_history_entry
+from goals.notifications import send_goal_notification, create_message_history_entry, append_message_history
 import logging
 
 logger = logging.getLogger(__name__)
@@ -23,6 +25,12 @@ class Command(BaseCommand):
             action='store_true',
             help='Calculate targets but skip sending notifications',
         )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=getattr(settings, 'GOAL_NOTIFICATION_BATCH_SIZE', 50),
+            help='Notifications sent per SMTP connection before reconnecting (default: 50)',
+        )
 
     def handle(self, *args, **options):
         today = date.today()
@@ -34,31 +42,35 @@ class Command(BaseCommand):
         participant_id = options.get('participant_id')
         if participant_id:
             try:
-                participant = Participant.objects.get(id=participant_id)
+                participant = Participant.objects.select_related('user').get(id=participant_id)
                 self.calculate_for_participant(participant, skip_notifications)
             except Participant.DoesNotExist:
                 self.stdout.write(self.style.ERROR(f"Participant {participant_id} not found"))
             return
 
-        # Get all participants
-        all_participants = Participant.objects.select_related('user').all()
+        # Cheap first pass over start dates only - the JSON-heavy columns
+        # (daily_steps, targets, message_history) are loaded just for the
+        # participants actually on their target day
+        active_participants = Participant.objects.filter(user__is_active=True).values_list('id', 'start_date')
 
         # Filter to those on target day AND active
         # Safety: Filter out participants with missing/invalid start_date first
-        target_day_participants = []
-        for p in all_participants:
-            if not p.user or not p.user.is_active:
-                continue
-            if not p.start_date:
-                logger.warning(f"Participant {p.id} has no start_date - skipping")
+        target_day_ids = []
+        for participant_pk, start_date in active_participants:
+            if not start_date:
+                logger.warning(f"Participant {participant_pk} has no start_date - skipping")
                 continue
             try:
-                if is_target_day(p.start_date):
-                    target_day_participants.append(p)
+                if is_target_day(start_date, today):
+                    target_day_ids.append(participant_pk)
             except Exception as e:
-                logger.error(f"Error checking target day for participant {p.id}: {e}")
+                logger.error(f"Error checking target day for participant {participant_pk}: {e}")
                 continue
 
+        target_day_participants = list(
+            Participant.objects.select_related('user').filter(id__in=target_day_ids).order_by('id')
+        )
+
         if not target_day_participants:
             self.stdout.write(self.style.WARNING("No active participants on target day today"))
             return
@@ -74,25 +86,42 @@ class Command(BaseCommand):
         skipped_week_count = 0
         error_count = 0
 
-        for participant in target_day_participants:
-            result = self.calculate_for_participant(participant, skip_notifications)
+        # One SMTP connection per batch instead of one per email - recycled
+        # every batch_size participants so no session runs into server limits
+        batch_size = max(options['batch_size'], 1)
+        connection = None
 
-            if result['status'] == 'success':
-                success_count += 1
-                if result.get('notification_sent'):
-                    notification_sent_count += 1
-                elif result.get('notification_failed'):
-                    notification_failed_count += 1
-            elif result['status'] == 'no_target':
-                no_target_count += 1
-            elif result['status'] == 'no_data_today':
-                no_data_today_count += 1
-            elif result['status'] == 'already_exists':
-                already_exists_count += 1
-            elif result['status'] == 'skipped_week':
-                skipped_week_count += 1
-            else:
-                error_count += 1
+        # Every message sent in this run shares one timestamp
+        run_timestamp = timezone.now()
+
+        try:
+            for i, participant in enumerate(target_day_participants):
+                if not skip_notifications and i % batch_size == 0:
+                    if connection is not None:
+                        connection.close()
+                    connection = self.open_connection()
+
+                result = self.calculate_for_participant(participant, skip_notifications, connection, run_timestamp)
+
+                if result['status'] == 'success':
+                    success_count += 1
+                    if result.get('notification_sent'):
+                        notification_sent_count += 1
+                    elif result.get('notification_failed'):
+                        notification_failed_count += 1
+                elif result['status'] == 'no_target':
+                    no_target_count += 1
+                elif result['status'] == 'no_data_today':
+                    no_data_today_count += 1
+                elif result['status'] == 'already_exists':
+                    already_exists_count += 1
+                elif result['status'] == 'skipped_week':
+                    skipped_week_count += 1
+                else:
+                    error_count += 1
+        finally:
+            if connection is not None:
+                connection.close()
 
         # Summary
         self.stdout.write("\n" + "="*60)
@@ -114,7 +143,17 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f"  ✗ Errors: {error_count}"))
         self.stdout.write("="*60)
 
-    def calculate_for_participant(self, participant, skip_notifications=False):
+    def open_connection(self):
+        """Open a shared SMTP connection for a batch of notifications"""
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as e:
+            # Each send will retry the connection and record its own failure
+            logger.warning(f"Could not open SMTP connection up front: {e}")
+        return connection
+
+    def calculate_for_participant(self, participant, skip_notifications=False, connection=None, timestamp=None):
         """Calculate target for a single participant and optionally send notification"""
         result = {
             'status': None,
@@ -125,7 +164,7 @@ class Command(BaseCommand):
 
         try:
             today = date.today()
-            today_str = today.strftime('%Y-%m-%d')
+            today_str = today.isoformat()
 
             # Check if target already exists for today
             targets = participant.targets or {}
@@ -166,7 +205,7 @@ class Command(BaseCommand):
                             f"⚠  {participant.user.email}: No data for target day by 17:00 - using fallback logic"
                         )
                     )
-                    return self.calculate_with_fallback(participant, skip_notifications)
+                    return self.calculate_with_fallback(participant, skip_notifications, connection, timestamp)
                 else:
                     # Not 5 PM yet - wait for next hour
                     self.stdout.write(
@@ -190,7 +229,9 @@ class Command(BaseCommand):
 
                 # Handle notification
                 if not skip_notifications:
-                    notification_result = send_goal_notification(participant, goal_data)
+                    notification_result = send_goal_notification(
+                        participant, goal_data, connection=connection, timestamp=timestamp
+                    )
                     
                     if notification_result['success']:
                         result['notification_sent'] = True
@@ -222,13 +263,8 @@ class Command(BaseCommand):
                         participant.language
                     )
                     
-                    # FIXED: Use copy/reassign pattern for JSONField
-                    message_history = (participant.message_history or []).copy()
-                    message_history.append(message_entry)
-                    participant.message_history = message_history
-                    
-                    # Save participant with message history (status_flags already saved by _log_status_flag)
-                    participant.save(update_fields=['message_history'])
+                    # status_flags already saved by _log_status_flag
+                    append_message_history(participant, message_entry)
                     logger.info(f"Message logged for participant {participant.id}")
                         
                 else:
@@ -252,7 +288,7 @@ class Command(BaseCommand):
             result['status'] = 'error'
             return result
     
-    def calculate_with_fallback(self, participant, skip_notifications=False):
+    def calculate_with_fallback(self, participant, skip_notifications=False, connection=None, timestamp=None):
         """
         Fallback logic when target day has no data by 17:00.
         - If >= 4 days of data in past 7 days: Calculate from those days
@@ -267,7 +303,7 @@ class Command(BaseCommand):
         
         try:
             today = date.today()
-            today_str = today.strftime('%Y-%m-%d')
+            today_str = today.isoformat()
             
             # Count days with data in the past 7 days (not including today)
             daily_steps = participant.daily_steps or []
@@ -279,16 +315,20 @@ class Command(BaseCommand):
                 except (ValueError, TypeError):
                     return default
             
+            # Index the dates with steps once instead of rescanning daily_steps per day
+            dates_with_steps = {
+                entry.get('date') for entry in daily_steps
+                if safe_int(entry.get('value')) > 0
+            }
+            
             # Get past 7 days (yesterday and 6 days before)
             past_7_days = [today - timedelta(days=i) for i in range(1, 8)]
             days_with_data = []
             
             for check_date in past_7_days:
-                check_date_str = check_date.strftime('%Y-%m-%d')
-                for entry in daily_steps:
-                    if entry.get('date') == check_date_str and safe_int(entry.get('value')) > 0:
-                        days_with_data.append(check_date_str)
-                        break
+                check_date_str = check_date.isoformat()
+                if check_date_str in dates_with_steps:
+                    days_with_data.append(check_date_str)
             
             days_count = len(days_with_data)
             
@@ -359,7 +399,9 @@ class Command(BaseCommand):
                 
                 # Send notification
                 if not skip_notifications:
-                    notification_result = send_goal_notification(participant, goal_data)
+                    notification_result = send_goal_notification(
+                        participant, goal_data, connection=connection, timestamp=timestamp
+                    )
                     
                     if notification_result['success']:
                         result['notification_sent'] = True
@@ -385,10 +427,7 @@ class Command(BaseCommand):
                         goal_data, 
                         participant.language
                     )
-                    message_history = (participant.message_history or []).copy()
-                    message_history.append(message_entry)
-                    participant.message_history = message_history
-                    participant.save(update_fields=['message_history'])
+                    append_message_history(participant, message_entry)
                 
                 return result
                     
@@ -407,7 +446,7 @@ class Command(BaseCommand):
                 # Find most recent valid target (skip back over any previous skipped weeks)
                 check_date = today - timedelta(days=7)
                 for _ in range(10):  # Check up to 10 weeks back
-                    check_date_str = check_date.strftime('%Y-%m-%d')
+                    check_date_str = check_date.isoformat()
                     if check_date_str in targets:
                         target_data = targets[check_date_str]
                         if target_data.get('calculation_method') != 'skipped_week':
@@ -441,6 +480,7 @@ class Command(BaseCommand):
                 goal_data = {
                     'new_target': previous_target,
                     'average_steps': 'insufficient_data',
+                    'insufficient': True,
                     'target_was_met': None,
                     'previous_target': previous_target
                 }
@@ -452,7 +492,9 @@ class Command(BaseCommand):
                 
                 # Send notification about skipped week
                 if not skip_notifications:
-                    notification_result = send_goal_notification(participant, goal_data)
+                    notification_result = send_goal_notification(
+                        participant, goal_data, connection=connection, timestamp=timestamp
+                    )
                     
                     if notification_result['success']:
                         result['notification_sent'] = True
@@ -473,10 +515,7 @@ class Command(BaseCommand):
                         goal_data, 
                         participant.language
                     )
-                    message_history = (participant.message_history or []).copy()
-                    message_history.append(message_entry)
-                    participant.message_history = message_history
-                    participant.save(update_fields=['message_history'])
+                    append_message_history(participant, message_entry)
                 
                 return result
                 
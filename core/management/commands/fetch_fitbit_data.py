@@ -1,5 +1,7 @@
 # core/management/commands/fetch_fitbit_data.py
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from django.core.management.base import BaseCommand
+from django.db import connections
 from django.utils import timezone
 from core.models import Participant
 from device_integration.fitbit import fetch_fitbit_data_for_participant, _log_status_flag
@@ -21,6 +23,12 @@ class Command(BaseCommand):
             action='store_true',
             help='Force refetch all data from start date',
         )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of participants to fetch in parallel (default: 4)',
+        )
     
     def handle(self, *args, **options):
         start_time = timezone.now()
@@ -29,7 +37,7 @@ class Command(BaseCommand):
         # Get participants to process
         if options['participant_id']:
             try:
-                participant = Participant.objects.get(id=options['participant_id'])
+                participant = Participant.objects.select_related('user').get(id=options['participant_id'])
                 all_participants = [participant]
             except Participant.DoesNotExist:
                 self.stderr.write(
@@ -78,18 +86,30 @@ class Command(BaseCommand):
         success_count = 0
         api_error_count = 0
         
-        for participant in valid_token_participants:
-            try:
-                if self.fetch_for_participant(participant, force=options['force']):
-                    success_count += 1
-                else:
+        # Fitbit rate limits are per user, so participants can be fetched side by side
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            futures = {
+                executor.submit(self.fetch_in_thread, participant, options['force']): participant
+                for participant in valid_token_participants
+            }
+            # Workers only return their result - all output is written here so
+            # lines from different participants never interleave
+            for future in as_completed(futures):
+                participant = futures[future]
+                try:
+                    success, message = future.result()
+                    if success:
+                        success_count += 1
+                        self.stdout.write(self.style.SUCCESS(f"✓ {participant.user.email}: {message}"))
+                    else:
+                        api_error_count += 1
+                        self.stdout.write(self.style.ERROR(f"✗ {participant.user.email}: {message}"))
+                except Exception as e:
                     api_error_count += 1
-            except Exception as e:
-                api_error_count += 1
-                logger.exception(f"Unexpected error for participant {participant.id}")
-                self.stdout.write(
-                    self.style.ERROR(f"✗ {participant.user.email}: Unexpected error - {str(e)}")
-                )
+                    logger.exception(f"Unexpected error for participant {participant.id}")
+                    self.stdout.write(
+                        self.style.ERROR(f"✗ {participant.user.email}: Unexpected error - {str(e)}")
+                    )
         
         # Summary
         end_time = timezone.now()
@@ -104,36 +124,29 @@ class Command(BaseCommand):
             self.stdout.write(self.style.WARNING(f"  ⚠  No Token: {len(invalid_token_participants)}"))
         self.stdout.write("="*50)
     
+    def fetch_in_thread(self, participant, force=False):
+        """Run fetch_for_participant in a worker thread and release its DB connection"""
+        try:
+            return self.fetch_for_participant(participant, force=force)
+        finally:
+            connections.close_all()
+
     def fetch_for_participant(self, participant, force=False):
-        """Fetch data for a single participant and return success status"""
+        """Fetch data for a single participant and return (success, message) for the caller to report"""
         try:
             result, status = fetch_fitbit_data_for_participant(
                 participant.id,
-                force_refetch=force
+                force_refetch=force,
+                participant=participant
             )
             
             if status == 200:
                 steps_count = len(result.get('steps', []))
                 message = result.get('message', '')
-                if message:
-                    self.stdout.write(
-                        self.style.SUCCESS(f"✓ {participant.user.email}: {message}")
-                    )
-                else:
-                    self.stdout.write(
-                        self.style.SUCCESS(f"✓ {participant.user.email}: {steps_count} days fetched")
-                    )
-                return True
+                return True, message or f"{steps_count} days fetched"
             else:
-                error_msg = result.get('error', 'Unknown error')
-                self.stdout.write(
-                    self.style.ERROR(f"✗ {participant.user.email}: {error_msg}")
-                )
-                return False
+                return False, result.get('error', 'Unknown error')
                 
         except Exception as e:
-            self.stdout.write(
-                self.style.ERROR(f"✗ {participant.user.email}: {str(e)}")
-            )
             logger.exception(f"Error fetching Fitbit data for participant {participant.id}")
-            return False
\ No newline at end of file
+            return False, str(e)
\ No newline at end of file
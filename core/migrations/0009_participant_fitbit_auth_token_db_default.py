@@ -0,0 +1,27 @@
+import uuid
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_participant_treatment_arm'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='participant',
+            name='fitbit_auth_token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        # Database-level default so participants created outside the ORM
+        # (raw SQL, restores) still get a token. Django 4.2 has no db_default,
+        # so this DEFAULT is invisible to the migration state - a later
+        # AlterField on fitbit_auth_token may drop it and would need to
+        # re-apply this RunSQL.
+        migrations.RunSQL(
+            sql="ALTER TABLE core_participant ALTER COLUMN fitbit_auth_token SET DEFAULT gen_random_uuid();",
+            reverse_sql="ALTER TABLE core_participant ALTER COLUMN fitbit_auth_token DROP DEFAULT;",
+        ),
+    ]
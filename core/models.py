@@ -4,6 +4,7 @@ from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db import models
 from django.conf import settings
 from django.core.validators import MinLengthValidator, RegexValidator
+from django.utils.functional import cached_property
 import uuid
 
 class CustomUserManager(BaseUserManager):
@@ -85,7 +86,7 @@ class Participant(models.Model):
     fitbit_access_token = models.TextField(null=True, blank=True)
     fitbit_refresh_token = models.TextField(null=True, blank=True)
     fitbit_token_expires = models.DateTimeField(null=True, blank=True)
-    fitbit_auth_token = models.UUIDField(default=uuid.uuid4, unique=True)
+    fitbit_auth_token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
     
     # New: Status flags for error/success tracking (Fitbit and general process)
     status_flags = models.JSONField(default=dict, blank=True, help_text="Flexible status and error flags for sync, auth, etc.")
@@ -95,4 +96,9 @@ class Participant(models.Model):
     
     @property
     def email(self):
-        return self.user.email
\ No newline at end of file
+        return self.user.email
+
+    @cached_property
+    def fitbit_auth_token_str(self):
+        """String form of fitbit_auth_token, used as the OAuth state value"""
+        return str(self.fitbit_auth_token)
@@ -0,0 +1,43 @@
+# core/status_flags.py
+import json
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from core.models import Participant
+
+
+def set_status_flag(participant, key, error_message=None):
+    """
+    Set or clear a status flag in memory. Returns the SQL expression that
+    applies the same change to the stored status_flags - the caller saves.
+    """
+    if error_message:
+        patch = {
+            key: True,
+            f"{key}_last_error": error_message,
+            f"{key}_last_error_time": timezone.now().isoformat(),
+        }
+        removed = []
+    else:
+        patch = {key: False}
+        removed = [f"{key}_last_error", f"{key}_last_error_time"]
+
+    # Keep the in-memory copy in step with the database
+    if not participant.status_flags:
+        participant.status_flags = {}
+    participant.status_flags.update(patch)
+    for flag in removed:
+        participant.status_flags.pop(flag, None)
+
+    # Patch only the affected keys at DB level instead of rewriting the whole
+    # JSON blob - also avoids lost updates when flags are written concurrently
+    return RawSQL(
+        "(COALESCE(status_flags, '{}'::jsonb) - %s::text[]) || %s::jsonb",
+        [removed, json.dumps(patch)],
+    )
+
+
+def log_status_flag(participant, key, error_message=None):
+    """Set or clear a status flag and save it straight away."""
+    Participant.objects.filter(pk=participant.pk).update(
+        status_flags=set_status_flag(participant, key, error_message)
+    )
@@ -1,33 +1,97 @@
 # device_integration/fitbit.py
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
 import logging
 import base64
-from datetime import datetime, timedelta
+from datetime import date, timedelta
+from urllib.parse import quote, urlencode
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from core.models import Participant
+from core.status_flags import log_status_flag as _log_status_flag
 
-###############
-# Helpers
-def _log_status_flag(participant, key, error_message=None):
-    """Helper to set or clear status flags for Fitbit operations."""
-    # Get a mutable copy of status_flags to ensure Django detects the change
-    flags = participant.status_flags.copy() if participant.status_flags else {}
-    
-    if error_message:
-        flags[key] = True
-        flags[f"{key}_last_error"] = error_message
-        flags[f"{key}_last_error_time"] = timezone.now().isoformat()
-    else:
-        flags[key] = False
-        flags.pop(f"{key}_last_error", None)
-        flags.pop(f"{key}_last_error_time", None)
-    
-    # Reassign to trigger JSONField update detection
-    participant.status_flags = flags
-    participant.save(update_fields=["status_flags"])
+logger = logging.getLogger(__name__)
+
+# Longest Retry-After wait (seconds) we will sleep through before retrying
+FITBIT_MAX_RETRY_AFTER = 10
+
+class _FitbitRetry(Retry):
+    """
+    Retry that honours short Retry-After waits but gives up on long ones.
+    Fitbit's 429 Retry-After runs until the hourly quota resets, which can be
+    most of an hour - far longer than a request or worker should block.
+    """
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None and self.respect_retry_after_header:
+            retry_after = self.get_retry_after(response)
+            if retry_after and retry_after > FITBIT_MAX_RETRY_AFTER:
+                raise MaxRetryError(_pool, url, ResponseError(f"Retry-After {retry_after}s exceeds limit"))
+        return super().increment(method, url, response=response, error=error, _pool=_pool, _stacktrace=_stacktrace)
+
+# Shared session so Fitbit calls reuse pooled keep-alive connections instead of
+# a new TCP+TLS handshake per request. POSTs are not retried (refresh tokens are
+# single use); the final response is returned so status checks below still apply.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=_FitbitRetry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    ),
+))
+
+# (connect, read) timeout for every Fitbit API call
+FITBIT_TIMEOUT = (3.05, 10)
+
+# Fitbit app credentials, read from settings once at import
+FITBIT_CLIENT_ID = settings.FITBIT_CLIENT_ID
+FITBIT_CLIENT_SECRET = settings.FITBIT_CLIENT_SECRET
+FITBIT_REDIRECT_URI = settings.FITBIT_REDIRECT_URI
+
+# Basic auth header for the OAuth token endpoint, built once at import
+if not (FITBIT_CLIENT_ID and FITBIT_CLIENT_SECRET):
+    logger.warning("FITBIT_CLIENT_ID/FITBIT_CLIENT_SECRET not set - Fitbit token requests will fail")
+_FITBIT_BASIC_AUTH = "Basic " + base64.b64encode(
+    f"{FITBIT_CLIENT_ID}:{FITBIT_CLIENT_SECRET}".encode()
+).decode()
+
+# Constant part of the authorization URL query; only state varies per participant
+_FITBIT_AUTHORIZE_QS = urlencode({
+    "response_type": "code",
+    "client_id": FITBIT_CLIENT_ID,
+    "redirect_uri": FITBIT_REDIRECT_URI,
+    "scope": "activity heartrate profile",
+    "prompt": "login",
+})
+
+# Largest steps response body we are prepared to read
+FITBIT_MAX_RESPONSE_BYTES = 10_000_000
+
+# How long an OAuth state -> participant mapping is kept after starting authorization
+FITBIT_STATE_CACHE_TIMEOUT = 600
+
+# How long a Fitbit response ETag is kept for conditional re-fetches
+FITBIT_ETAG_CACHE_TIMEOUT = 60 * 60 * 24
+
+# Participant columns read or written by fetch_fitbit_data_for_participant
+FITBIT_SYNC_FIELDS = (
+    "start_date",
+    "daily_steps",
+    "status_flags",
+    "fitbit_access_token",
+    "fitbit_refresh_token",
+    "fitbit_token_expires",
+)
 
 ###############
 # Token helpers
@@ -37,13 +101,8 @@ def refresh_fitbit_tokens(participant):
         return participant.fitbit_access_token
 
     token_url = "https://api.fitbit.com/oauth2/token"
-    client_id = settings.FITBIT_CLIENT_ID
-    client_secret = settings.FITBIT_CLIENT_SECRET
-    credentials = f"{client_id}:{client_secret}"
-    basic_auth = base64.b64encode(credentials.encode()).decode()
-
     headers = {
-        "Authorization": f"Basic {basic_auth}",
+        "Authorization": _FITBIT_BASIC_AUTH,
         "Content-Type": "application/x-www-form-urlencoded",
     }
     data = {
@@ -51,7 +110,7 @@ def refresh_fitbit_tokens(participant):
         "refresh_token": participant.fitbit_refresh_token,
     }
 
-    resp = requests.post(token_url, headers=headers, data=data)
+    resp = _SESSION.post(token_url, headers=headers, data=data, timeout=FITBIT_TIMEOUT)
     if resp.status_code != 200:
         error_msg = f"Failed to refresh Fitbit token: {resp.text}"
         _log_status_flag(participant, "refresh_fitbit_token_fail", error_msg)
@@ -64,46 +123,47 @@ def refresh_fitbit_tokens(participant):
     participant.fitbit_access_token = tokens["access_token"]
     participant.fitbit_refresh_token = tokens["refresh_token"]
     participant.fitbit_token_expires = timezone.now() + timedelta(seconds=tokens["expires_in"])
-    participant.save(update_fields=["fitbit_access_token", "fitbit_refresh_token", "fitbit_token_expires", "status_flags"])
+    participant.save(update_fields=["fitbit_access_token", "fitbit_refresh_token", "fitbit_token_expires"])
     return participant.fitbit_access_token
 
 ###############
 # Authorization URL
+def _fitbit_state_cache_key(state):
+    return f"fitbit:state:{state}"
+
 def get_authorize_url(participant):
-    from urllib.parse import urlencode
-    params = {
-        "response_type": "code",
-        "client_id": settings.FITBIT_CLIENT_ID,
-        "redirect_uri": settings.FITBIT_REDIRECT_URI,
-        "scope": "activity heartrate profile",
-        "state": str(participant.fitbit_auth_token),
-        "prompt": "login",
-    }
-    return f"https://www.fitbit.com/oauth2/authorize?{urlencode(params)}"
+    # Map state to participant for the callback, which then looks up by primary key
+    cache.set(_fitbit_state_cache_key(participant.fitbit_auth_token_str), participant.pk, timeout=FITBIT_STATE_CACHE_TIMEOUT)
+    return f"https://www.fitbit.com/oauth2/authorize?{_FITBIT_AUTHORIZE_QS}&state={quote(participant.fitbit_auth_token_str)}"
 
 ###############
 # Exchange code for tokens
 def exchange_code_for_tokens(code, state):
+    # Single use: the cached state mapping is dropped once read
+    state_key = _fitbit_state_cache_key(state)
+    participant_id = cache.get(state_key)
+    cache.delete(state_key)
     try:
-        participant = Participant.objects.get(fitbit_auth_token=state)
-    except Participant.DoesNotExist:
+        if participant_id:
+            participant = Participant.objects.get(pk=participant_id)
+        else:
+            participant = Participant.objects.get(fitbit_auth_token=state)
+    except (Participant.DoesNotExist, ValidationError):
         return None, "Participant not found"
 
     token_url = "https://api.fitbit.com/oauth2/token"
     data = {
-        "client_id": settings.FITBIT_CLIENT_ID,
+        "client_id": FITBIT_CLIENT_ID,
         "grant_type": "authorization_code",
-        "redirect_uri": settings.FITBIT_REDIRECT_URI,
+        "redirect_uri": FITBIT_REDIRECT_URI,
         "code": code,
     }
-    credentials = f"{settings.FITBIT_CLIENT_ID}:{settings.FITBIT_CLIENT_SECRET}"
-    basic_auth = base64.b64encode(credentials.encode()).decode()
     headers = {
-        "Authorization": f"Basic {basic_auth}",
+        "Authorization": _FITBIT_BASIC_AUTH,
         "Content-Type": "application/x-www-form-urlencoded",
     }
 
-    resp = requests.post(token_url, data=data, headers=headers)
+    resp = _SESSION.post(token_url, data=data, headers=headers, timeout=FITBIT_TIMEOUT)
     if resp.status_code != 200:
         return None, f"Token exchange failed: {resp.text}"
 
@@ -112,15 +172,18 @@ def exchange_code_for_tokens(code, state):
     refresh_token = tokens.get("refresh_token")
     expires_in = tokens.get("expires_in")
 
-    # Fetch Fitbit profile
-    profile_resp = requests.get(
-        "https://api.fitbit.com/1/user/-/profile.json",
-        headers={"Authorization": f"Bearer {access_token}"}
-    )
-    if profile_resp.status_code != 200:
-        return None, f"Failed to fetch profile: {profile_resp.text}"
+    # The token response carries the encoded user ID; only fall back to the profile call without it
+    fitbit_user_id = tokens.get("user_id")
+    if not fitbit_user_id:
+        profile_resp = _SESSION.get(
+            "https://api.fitbit.com/1/user/-/profile.json",
+            headers={"Authorization": f"Bearer {access_token}"},
+            timeout=FITBIT_TIMEOUT,
+        )
+        if profile_resp.status_code != 200:
+            return None, f"Failed to fetch profile: {profile_resp.text}"
 
-    fitbit_user_id = profile_resp.json().get("user", {}).get("encodedId")
+        fitbit_user_id = profile_resp.json().get("user", {}).get("encodedId")
     
     # VALIDATE: Compare authenticated ID with pre-entered ID
     if participant.fitbit_user_id and participant.fitbit_user_id != "tempid" and participant.fitbit_user_id != fitbit_user_id:
@@ -152,9 +215,12 @@ def exchange_code_for_tokens(code, state):
 
 ###############
 # Fetch Fitbit steps (with incremental fetch)
-def fetch_fitbit_data_for_participant(participant_id, force_refetch=False):
-    participant = get_object_or_404(Participant, pk=participant_id)
-    print(f"--- Fetching Fitbit data for participant {participant_id} ---")
+def fetch_fitbit_data_for_participant(participant_id, force_refetch=False, participant=None):
+    # Callers that already hold the participant pass it in to skip a second SELECT
+    if participant is None:
+        # Only load the columns the sync touches - skips targets/message_history JSON
+        participant = get_object_or_404(Participant.objects.only(*FITBIT_SYNC_FIELDS), pk=participant_id)
+    logger.debug("Fetching Fitbit data for participant %s", participant_id)
 
     if not participant.fitbit_access_token:
         _log_status_flag(participant, "fetch_fitbit_data_fail", "No Fitbit access token")
@@ -166,8 +232,9 @@ def fetch_fitbit_data_for_participant(participant_id, force_refetch=False):
         if force_refetch or not daily_steps:
             start_fetch_date = participant.start_date - timedelta(days=7)
         else:
+            # Admin edits can leave daily_steps unsorted, so take the latest date
             last_date = max(day["date"] for day in daily_steps)
-            start_fetch_date = datetime.strptime(last_date, "%Y-%m-%d").date()
+            start_fetch_date = date.fromisoformat(last_date)
 
         end_fetch_date = min(timezone.now().date(), participant.start_date + timedelta(days=365))
         
@@ -187,33 +254,53 @@ def fetch_fitbit_data_for_participant(participant_id, force_refetch=False):
         # Fetch steps from Fitbit API
         url = f"https://api.fitbit.com/1/user/-/activities/steps/date/{start_fetch_date}/{end_fetch_date}.json"
         headers = {"Authorization": f"Bearer {access_token}"}
-        resp = requests.get(url, headers=headers)
+
+        # Send the previous ETag for this range so an unchanged response comes back as a bodiless 304
+        etag_key = f"fitbit:etag:{participant_id}:{start_fetch_date}:{end_fetch_date}"
+        etag = None if force_refetch else cache.get(etag_key)
+        if etag:
+            headers["If-None-Match"] = etag
+
+        # Stream so an oversized body can be refused before it is read into memory
+        resp = _SESSION.get(url, headers=headers, timeout=FITBIT_TIMEOUT, stream=True)
+        if resp.status_code == 304:
+            resp.close()
+            return {"steps": daily_steps, "message": "Already up to date"}, 200
+        if int(resp.headers.get("Content-Length", 0)) > FITBIT_MAX_RESPONSE_BYTES:
+            resp.close()
+            error_msg = f"Fitbit response too large ({resp.headers['Content-Length']} bytes)"
+            _log_status_flag(participant, "fetch_fitbit_data_fail", error_msg)
+            return {"error": error_msg}, 502
         if resp.status_code != 200:
             _log_status_flag(participant, "fetch_fitbit_data_fail", f"Fitbit API error {resp.status_code}: {resp.text}")
             return {"error": resp.text}, resp.status_code
 
-        # Process steps
-        steps = resp.json().get("activities-steps", [])
-        new_steps = [{"date": d["dateTime"], "value": int(d.get("value", 0))} for d in steps if int(d.get("value", 0)) > 0]
+        # Process steps - merge non-zero days straight into the existing data
         steps_dict = {day["date"]: day for day in daily_steps}
-        for day in new_steps:
-            steps_dict[day["date"]] = day
+        # One int() per day - values may arrive as strings or ints, and a day
+        # without a value counts as zero
+        for d in resp.json().get("activities-steps", []):
+            value = int(d.get("value", 0))
+            if value > 0:
+                steps_dict[d["dateTime"]] = {"date": d["dateTime"], "value": value}
         merged_steps = sorted(steps_dict.values(), key=lambda x: x["date"])
         participant.daily_steps = merged_steps
-        # Note: Error flag already cleared at top of try block
-        participant.save(update_fields=["daily_steps", "status_flags"])
-        print(f"Fetched and merged {len(merged_steps)} days of step data.")
+        # Note: Error flag already cleared (and saved) at top of try block
+        participant.save(update_fields=["daily_steps"])
+        if resp.headers.get("ETag"):
+            cache.set(etag_key, resp.headers["ETag"], timeout=FITBIT_ETAG_CACHE_TIMEOUT)
+        logger.debug("Fetched and merged %s days of step data", len(merged_steps))
 
         return {"steps": merged_steps}, 200
 
     except requests.RequestException as e:
         error_msg = f"Fitbit API request failed: {e}"
-        logging.error(error_msg)
+        logger.error(error_msg)
         _log_status_flag(participant, "fetch_fitbit_data_fail", error_msg)
         return {"error": "Failed to fetch data from Fitbit"}, 500
     except Exception as e:
         error_msg = f"Unexpected error: {e}"
-        logging.error(error_msg)
+        logger.error(error_msg)
         _log_status_flag(participant, "fetch_fitbit_data_fail", error_msg)
         return {"error": "Internal server error"}, 500
 
@@ -221,8 +308,7 @@ def fetch_fitbit_data_for_participant(participant_id, force_refetch=False):
 # Add device account
 def add_device_account_for_participant(participant, device_type):
     from core.models import DeviceAccount
-    if DeviceAccount.objects.filter(participant=participant, device_type=device_type).exists():
+    device, created = DeviceAccount.objects.get_or_create(participant=participant, device_type=device_type)
+    if not created:
         return None, f"{device_type} account already exists for this participant."
-    device = DeviceAccount(participant=participant, device_type=device_type)
-    device.save()
     return device, None
\ No newline at end of file
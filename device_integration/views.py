@@ -2,7 +2,7 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import HttpResponse
 from core.models import Participant
-from device_integration.fitbit import exchange_code_for_tokens, get_authorize_url, fetch_fitbit_data_for_participant
+from device_integration.fitbit import exchange_code_for_tokens, get_authorize_url, fetch_fitbit_data_for_participant, FITBIT_SYNC_FIELDS
 from django.http import JsonResponse
 
 def fitbit_callback(request):
@@ -27,8 +27,8 @@ def fitbit_auth_start(request, participant_id):
     return redirect(url)
     
 def fetch_fitbit_data(request, participant_id):
-    participant = get_object_or_404(Participant, pk=participant_id)
-    result, status = fetch_fitbit_data_for_participant(participant_id)
+    participant = get_object_or_404(Participant.objects.only(*FITBIT_SYNC_FIELDS, "fitbit_user_id"), pk=participant_id)
+    result, status = fetch_fitbit_data_for_participant(participant_id, participant=participant)
 
     if status == 200:
         context = {
@@ -1,14 +1,23 @@
 # goals/notifications.py
+import json
 import random
-from django.core.mail import send_mail
+import smtplib
+from functools import lru_cache
+from django.core.mail import EmailMessage, get_connection
 from django.conf import settings
+from django.db.models.expressions import RawSQL
 import logging
 from django.utils import timezone
+from core.models import Participant
 
 logger = logging.getLogger(__name__)
 
+# Sender and CC list, read once from settings at import
+_FROM_EMAIL = getattr(settings, 'DEFAULT_FROM_EMAIL', 'john.dowling@rimuhc.ca')
+_CC_LIST = tuple(getattr(settings, 'GOAL_NOTIFICATION_CC', ()))
+
 # English tips for when goals are NOT met
-ENGLISH_TIPS_NOT_MET = [
+ENGLISH_TIPS_NOT_MET = (
   "Some people prefer walking first thing in the morning, others do it during lunchtime, and for some it is easier to walk during the evening. What time of the day works best for you?",
   "Many people find it easier to go walk with someone. Who would you like to invite to join you on a walk?",
   "Try analyzing what got in the way of your reaching your walking goals. What could you do differently this week to deal with these obstacles?",
@@ -29,10 +38,10 @@ ENGLISH_TIPS_NOT_MET = [
   "Remember that taking a few steps is always better than none.",
   "We all have days when it is harder to be active. Don't worry it is normal. Tomorrow will be a new day",
   "Feeling low in energy? Our first response is often to sit and do less. However, for many people, just taking a 10-minute walk will make them feel better. Try it and see how it makes you feel"
-]
+)
 
 # English tips for when goals ARE met
-ENGLISH_TIPS_MET = [
+ENGLISH_TIPS_MET = (
 	"You are on track! Keep up the great work.",
 	"Well done. 😊",
 	"You are doing well! ",
@@ -43,10 +52,10 @@ ENGLISH_TIPS_MET = [
 	"Good job! Your commitment to health is showing.",
 	"Yay! You are working hard.",
 	"Cheers to you! You are reaching your targets.",
-]
+)
 
 # French tips for when goals are NOT met
-FRENCH_TIPS_NOT_MET = [
+FRENCH_TIPS_NOT_MET = (
   "Certaines personnes préfèrent marcher tôt le matin, d'autres le font pendant leur pause du midi, et pour d'autres encore, il est plus facile de marcher le soir. Quel moment de la journée vous convient le mieux ?",
   "Beaucoup de gens trouvent ça plus facile de marcher en compagnie de quelqu'un d'autre. Qui aimeriez-vous inviter à vous accompagner ?",
   "Essayez d'analyser ce qui vous a empêché d'atteindre vos objectifs de marche. Que pourriez-vous faire différemment cette semaine pour surmonter ces obstacles ?",
@@ -67,10 +76,10 @@ FRENCH_TIPS_NOT_MET = [
   "N'oubliez pas que faire quelques pas vaut toujours mieux que ne pas en faire du tout.",
   "Nous avons tous des jours où il est plus difficile d'être actif. Ne vous inquiétez pas, c'est normal. Demain sera un nouveau jour.",
   "Vous vous sentez en manque d'énergie ? Notre première réaction est souvent de nous asseoir et de faire moins d'efforts. Cependant, pour beaucoup de gens, une simple promenade de 10 minutes suffit à les aider à se sentir mieux. Essayez et voyez comment vous vous sentez."
-]
+)
 
 # French tips for when goals ARE met
-FRENCH_TIPS_MET = [
+FRENCH_TIPS_MET = (
   "Vous êtes sur la bonne voie ! Continuez comme ça.",
   "Bravo. 😊",
   "Vous vous faites bien ça !",
@@ -81,12 +90,59 @@ FRENCH_TIPS_MET = [
   "Bon travail ! Votre engagement en faveur de la santé se note.",
   "On voit que vous faites des efforts pour atteindre vos buts.",
   "Bravo ! Vous atteignez vos objectifs."
-]
+)
 
 # Contact footers
 ENGLISH_FOOTER = "\n\nIf you would like to contact a member of the research team, please email us at partnerstept2d@muhc.mcgill.ca or call us at 438-346-0479"
 FRENCH_FOOTER = "\n\nSi vous souhaitez contacter un membre de l'équipe de recherche, veuillez nous envoyer un courriel à partnerstept2d@muhc.mcgill.ca ou nous appeler au 438-346-0479"
 
+# Email subjects and sentence templates per language
+_LANG = {
+    'fr': {
+        'subject_normal': "Résumé du nombre de pas et nouvel objectif",
+        'subject_insuf': "Objectif de pas maintenu",
+        'no_data': "Nous n'avons pas suffisamment de données de pas cette semaine.",
+        'remains': "Votre objectif reste {t} pas par jour.",
+        'met': "Vous avez fait plus que le but de la semaine dernière qui était {p} pas par jour.\n",
+        'missed': "Vous avez fait moins que le but de la semaine dernière qui était {p} pas par jour.\n",
+        'body': (
+            "La semaine dernière vous avez fait un moyen de {avg} pas par jour.\n"
+            "{comparison}"
+            "Cela signifie que votre objectif pour la semaine prochaine est {t} pas par jour.\n"
+            "\n"
+            "{tip}" + FRENCH_FOOTER
+        ),
+        'footer': FRENCH_FOOTER,
+    },
+    'en': {
+        'subject_normal': "Step Count Summary and New Target",
+        'subject_insuf': "Step Target Maintained",
+        'no_data': "We don't have enough step data from this week.",
+        'remains': "Your target remains {t} steps per day.",
+        'met': "This was more than last week's target of {p} steps per day.\n",
+        'missed': "This was less than last week's target of {p} steps per day.\n",
+        'body': (
+            "Last week you did an average of {avg} steps per day.\n"
+            "{comparison}"
+            "Your target for next week is {t} steps per day.\n"
+            "\n"
+            "{tip}" + ENGLISH_FOOTER
+        ),
+        'footer': ENGLISH_FOOTER,
+    },
+}
+
+# Tip pools and their sizes keyed by (language, goal_met)
+_TIP_POOLS = {
+    ('en', True): (ENGLISH_TIPS_MET, len(ENGLISH_TIPS_MET)),
+    ('en', False): (ENGLISH_TIPS_NOT_MET, len(ENGLISH_TIPS_NOT_MET)),
+    ('fr', True): (FRENCH_TIPS_MET, len(FRENCH_TIPS_MET)),
+    ('fr', False): (FRENCH_TIPS_NOT_MET, len(FRENCH_TIPS_NOT_MET)),
+}
+
+# Module-local generator - keeps tip picks off the shared global RNG
+_rng = random.Random()
+
 def get_random_tip(language, goal_met):
     """
     Get a random motivational tip based on language and whether goal was met.
@@ -98,88 +154,66 @@ def get_random_tip(language, goal_met):
     Returns:
         str: Random tip message
     """
-    if language == 'fr':
-        if goal_met:
-            return random.choice(FRENCH_TIPS_MET)
-        else:
-            return random.choice(FRENCH_TIPS_NOT_MET)
-    else:  # Default to English
-        if goal_met:
-            return random.choice(ENGLISH_TIPS_MET)
-        else:
-            return random.choice(ENGLISH_TIPS_NOT_MET)
+    # Only an explicit True uses the met pool - first week and insufficient
+    # data (goal_met is None) draw from the not-met pool
+    pool, n = _TIP_POOLS[('fr' if language == 'fr' else 'en', goal_met is True)]
+    return pool[_rng.randrange(n)]
+
+@lru_cache(maxsize=64)
+def _insufficient_head(language, new_target):
+    """Fixed part of the insufficient-data email - the tip is added per call."""
+    L = _LANG[language]
+    return "\n".join([L['no_data'], L['remains'].format(t=new_target), "", ""])
 
 def create_email_content(participant, goal_data):
     """
     Create bilingual email content based on participant's language preference.
     """
-    language = participant.language
+    language = 'fr' if participant.language == 'fr' else 'en'
+    L = _LANG[language]
     average_steps = goal_data.get('average_steps')
     new_target = goal_data.get('new_target')
     target_was_met = goal_data.get('target_was_met')
     previous_target = goal_data.get('previous_target')
     
-    # Handle insufficient data case
-    if average_steps == "insufficient data":
-        if language == 'fr':
-            subject = "Objectif de pas maintenu"
-            message_lines = [
-                "Nous n'avons pas suffisamment de données de pas cette semaine.",
-                f"Votre objectif reste {new_target} pas par jour."
-            ]
-            tip = get_random_tip('fr', None)
-            message_lines.append(f"\n{tip}")
-        else:
-            subject = "Step Target Maintained"
-            message_lines = [
-                "We don't have enough step data from this week.",
-                f"Your target remains {new_target} steps per day."
-            ]
-            tip = get_random_tip('en', None)
-            message_lines.append(f"\n{tip}")
-        
-        footer = FRENCH_FOOTER if language == 'fr' else ENGLISH_FOOTER
-        return subject, "\n".join(message_lines) + footer
+    # Handle insufficient data case (string check kept for older goal_data)
+    if goal_data.get('insufficient') or average_steps == "insufficient data":
+        body = _insufficient_head(language, new_target) + get_random_tip(language, None)
+        return L['subject_insuf'], body + L['footer']
     
-    # Normal case with valid step data
-    if language == 'fr':
-        subject = "Résumé du nombre de pas et nouvel objectif"
-        message_lines = [
-            f"La semaine dernière vous avez fait un moyen de {average_steps} pas par jour."
-        ]
-        
-        if target_was_met is not None and previous_target:
-            if target_was_met:
-                message_lines.append(f"Vous avez fait plus que le but de la semaine dernière qui était {previous_target} pas par jour.")
-            else:
-                message_lines.append(f"Vous avez fait moins que le but de la semaine dernière qui était {previous_target} pas par jour.")
-        
-        message_lines.append(f"Cela signifie que votre objectif pour la semaine prochaine est {new_target} pas par jour.")
-        tip = get_random_tip('fr', target_was_met)
-        message_lines.append(f"\n{tip}")
-        
-    else:
-        subject = "Step Count Summary and New Target"
-        message_lines = [
-            f"Last week you did an average of {average_steps} steps per day."
-        ]
-        
-        if target_was_met is not None and previous_target:
-            comparison = "more" if target_was_met else "less"
-            message_lines.append(f"This was {comparison} than last week's target of {previous_target} steps per day.")
-        
-        message_lines.append(f"Your target for next week is {new_target} steps per day.")
-        tip = get_random_tip('en', target_was_met)
-        message_lines.append(f"\n{tip}")
+    # Normal case with valid step data - one format_map over the whole body
+    comparison = ""
+    if target_was_met is not None and previous_target:
+        comparison = (L['met'] if target_was_met else L['missed']).format(p=previous_target)
     
-    footer = FRENCH_FOOTER if language == 'fr' else ENGLISH_FOOTER
-    return subject, "\n".join(message_lines) + footer
+    return L['subject_normal'], L['body'].format_map({
+        'avg': average_steps,
+        'comparison': comparison,
+        't': new_target,
+        'tip': get_random_tip(language, target_was_met),
+    })
     
     
-def send_goal_notification(participant, goal_data):
+def _send_with_reconnect(message, connection):
+    """Send on a shared connection, reopening it once if the server dropped it."""
+    try:
+        message.send(fail_silently=False)
+    except smtplib.SMTPServerDisconnected:
+        # Django never reopens a connection it still holds - reset it and
+        # retry this message once
+        logger.info("SMTP connection dropped, reconnecting for %s", message.to)
+        connection.close()
+        connection.open()
+        message.send(fail_silently=False)
+
+def send_goal_notification(participant, goal_data, connection=None, timestamp=None):
     """
     Send email notification to participant with their new weekly goal.
     Returns detailed status - caller handles model updates.
+    Pass an open mail connection to reuse one SMTP session across a batch -
+    if the server has dropped it, it is reopened and the send retried once.
+    The GOAL_NOTIFICATION_CC addresses get a separate "[CC]" copy.
+    Pass timestamp to stamp a whole batch with the same send time.
     
     Returns:
         dict: {
@@ -190,9 +224,8 @@ def send_goal_notification(participant, goal_data):
             'timestamp': str (ISO format)
         }
     """
-    from django.utils import timezone
-    
-    timestamp = timezone.now()
+    if timestamp is None:
+        timestamp = timezone.now()
     result = {
         'success': False,
         'error_message': None,
@@ -206,43 +239,57 @@ def send_goal_notification(participant, goal_data):
         result['subject'] = subject
         result['body'] = message_body
         
-        from_email = getattr(settings, 'DEFAULT_FROM_EMAIL', 'john.dowling@rimuhc.ca')
+        from_email = _FROM_EMAIL
         recipient_email = participant.user.email
-        
-        # ✅ Get CC list from settings, or default to empty
-        cc_list = getattr(settings, 'GOAL_NOTIFICATION_CC', [])
+        cc_list = _CC_LIST
+
+        # Participant email and CC copy share one SMTP session
+        own_connection = connection is None
+        if own_connection:
+            connection = get_connection()
 
         try:
-            send_mail(
+            if own_connection:
+                connection.open()
+
+            _send_with_reconnect(EmailMessage(
                 subject=subject,
-                message=message_body,
+                body=message_body,
                 from_email=from_email,
-                recipient_list=[recipient_email],
-                fail_silently=False,
-            )
-            
-            # ✅ Send a separate copy to CC addresses if any
-            if cc_list:
-                send_mail(
-                    subject=f"[CC] {subject}",
-                    message=message_body,
-                    from_email=from_email,
-                    recipient_list=cc_list,
-                    fail_silently=True,  # don't break participant emails if CC fails
-                )
+                to=[recipient_email],
+                connection=connection,
+            ), connection)
 
             result['success'] = True
-            logger.info(f"Goal notification sent to {recipient_email} in {participant.language}")
+            logger.info("Goal notification sent to %s in %s", recipient_email, participant.language)
             
-        except Exception as email_error:
+            # Staff get their own "[CC]" copy - a separate message, so its
+            # recipients can never mask a refused participant address
+            if cc_list:
+                try:
+                    _send_with_reconnect(EmailMessage(
+                        subject=f"[CC] {subject}",
+                        body=message_body,
+                        from_email=from_email,
+                        to=list(cc_list),
+                        connection=connection,
+                    ), connection)
+                except (smtplib.SMTPException, OSError) as cc_error:
+                    logger.warning("CC copy failed for %s: %s", recipient_email, cc_error)
+            
+        except (smtplib.SMTPException, OSError) as email_error:
+            # socket errors and timeouts are OSError
             result['error_message'] = f"SMTP error: {str(email_error)}"
-            logger.warning(f"Email sending failed for {recipient_email}: {result['error_message']}")
+            logger.warning("Email sending failed for %s: %s", recipient_email, result['error_message'])
+        finally:
+            if own_connection:
+                connection.close()
         
         return result
         
     except Exception as e:
         result['error_message'] = f"Content creation error: {str(e)}"
-        logger.error(f"Failed to create notification for participant {participant.id}: {result['error_message']}")
+        logger.error("Failed to create notification for participant %s: %s", participant.id, result['error_message'])
         return result
 
 
@@ -260,4 +307,18 @@ def create_message_history_entry(notification_result, goal_data, participant_lan
         },
         "email_sent": notification_result['success'],
         "error_message": notification_result.get('error_message')
-    }
\ No newline at end of file
+    }
+
+
+def append_message_history(participant, message_entry):
+    """Append one entry to the participant's message history."""
+    # Keep the in-memory copy in step with the database
+    participant.message_history = (participant.message_history or []) + [message_entry]
+
+    # Append at DB level instead of re-sending the whole history on every save
+    Participant.objects.filter(pk=participant.pk).update(
+        message_history=RawSQL(
+            "COALESCE(message_history, '[]'::jsonb) || jsonb_build_array(%s::jsonb)",
+            [json.dumps(message_entry)],
+        )
+    )
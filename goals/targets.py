@@ -1,58 +1,58 @@
 # goals/targets.py
-from datetime import datetime, date, timedelta
-from django.utils import timezone
+from bisect import bisect_right
+from datetime import date, datetime
+from django.db.models.expressions import RawSQL
+from core.models import Participant
+from core.status_flags import log_status_flag as _log_status_flag
+from core.status_flags import set_status_flag as _set_status_flag
+import json
 import logging
+import re
 
 logger = logging.getLogger(__name__)
 
-def _log_status_flag(participant, key, error_message=None):
-    """
-    Helper to set or clear status flags. 
-    Duplicated from device_integration/fitbit.py to avoid circular imports.
-    """
-    # Get a mutable copy of status_flags to ensure Django detects the change
-    flags = participant.status_flags.copy() if participant.status_flags else {}
-    
-    if error_message:
-        flags[key] = True
-        flags[f"{key}_last_error"] = error_message
-        flags[f"{key}_last_error_time"] = timezone.now().isoformat()
-    else:
-        flags[key] = False
-        flags.pop(f"{key}_last_error", None)
-        flags.pop(f"{key}_last_error_time", None)
-    
-    # Reassign to trigger JSONField update detection
-    participant.status_flags = flags
-    participant.save(update_fields=["status_flags"])
-
-def validate_step_data(step_value):
-    """Validate that step data is reasonable"""
+def validate_step_data(step_value, quiet=False):
+    """Validate that step data is reasonable - quiet skips the per-value warning"""
     if not isinstance(step_value, (int, float)):
-        logger.warning(f"Invalid step data type: {type(step_value)}")
+        if not quiet:
+            logger.warning(f"Invalid step data type: {type(step_value)}")
         return False
     
     if step_value < 1000:
-        logger.warning(f"Step count too low (< 1000): {step_value}")
+        if not quiet:
+            logger.warning(f"Step count too low (< 1000): {step_value}")
         return False
         
     if step_value > 100000:  # Unreasonably high
-        logger.warning(f"Unusually high step count: {step_value}")
+        if not quiet:
+            logger.warning(f"Unusually high step count: {step_value}")
         return False
         
     return True
 
+# Matrix value for a previous "increase to 10000" - a unique object, so no
+# int() parse of a stored increase can collide with it
+_TO_10000 = object()
+
+# Increase descriptions the algorithm writes, mapped to their matrix values
+_INCREASE_MAP = {
+    "maintain": 0,
+    "increase to 10000": _TO_10000,
+    "250": 250,
+    "500": 500,
+    "1000": 1000,
+}
+
 def _parse_increase_value(increase_str):
     """Convert increase string to comparable value for matrix logic"""
-    if increase_str == "maintain":
+    try:
+        value = _INCREASE_MAP.get(increase_str)
+        if value is not None:
+            return value
+        return int(increase_str)
+    except (ValueError, TypeError):
+        # Includes unhashable values from hand-edited targets JSON
         return 0
-    elif increase_str == "increase to 10000":
-        return "increase to 10000"
-    else:
-        try:
-            return int(increase_str)
-        except (ValueError, TypeError):
-            return 0
 
 def calculate_step_increase(current_avg, last_goal_data=None, target_was_met=True):
     """
@@ -91,121 +91,91 @@ def calculate_step_increase(current_avg, last_goal_data=None, target_was_met=Tru
     else:
         return _calculate_target_missed_matrix(current_avg, previous_increase)
 
-def is_target_day(participant_start_date):
+def is_target_day(participant_start_date, today=None):
     """Check if today is a target day for this participant"""
-    today = date.today()
-    delta_days = (today - participant_start_date).days
+    if today is None:
+        today = date.today()
+    delta_days = today.toordinal() - participant_start_date.toordinal()
     return delta_days >= 7 and delta_days % 7 == 0
     
+# Matrix outcomes as (increase description, step delta) - a delta of None
+# means the new target is 10000 outright
+_INC_250 = ("250", 250)
+_INC_500 = ("500", 500)
+_INC_1000 = ("1000", 1000)
+_INC_TO_10000 = ("increase to 10000", None)
+
+# current_avg band edges: bisect gives 0-3 for the bands below 10000 and
+# 4 for 10000+, which always maintains
+_AVG_BANDS = (5000, 7500, 9000, 10000)
+_MAINTAIN_BAND = len(_AVG_BANDS)
+
+# Outcome per current_avg band (<5000, <7500, <9000, <10000), one row per
+# previous increase. Unlisted (band, previous increase) pairs take the
+# default outcome (the PHP algorithm's fallback).
+_MET_BY_PREVIOUS = {
+    250: (_INC_500, _INC_500, _INC_1000, _INC_500),
+    500: (_INC_500, _INC_1000, _INC_1000, _INC_500),
+    1000: (_INC_500, _INC_1000, _INC_1000, _INC_500),
+}
+_MET_DEFAULT = _INC_500
+
+_MISSED_BY_PREVIOUS = {
+    250: (_INC_250, _INC_250, _INC_250, _INC_250),
+    500: (_INC_250, _INC_500, _INC_500, _INC_500),
+    1000: (_INC_500, _INC_500, _INC_500, _INC_500),
+    _TO_10000: (_INC_1000, _INC_1000, _INC_1000, _INC_TO_10000),
+}
+_MISSED_DEFAULT = _INC_250
+
+# First week outcome per current_avg band - no previous increase to consult
+_FIRST_WEEK = (_INC_500, _INC_1000, _INC_1000, _INC_TO_10000)
+
+# Flattened to (band, previous increase) -> outcome for a single lookup
+_MET_TABLE = {
+    (band, previous): outcome
+    for previous, row in _MET_BY_PREVIOUS.items()
+    for band, outcome in enumerate(row)
+}
+_MISSED_TABLE = {
+    (band, previous): outcome
+    for previous, row in _MISSED_BY_PREVIOUS.items()
+    for band, outcome in enumerate(row)
+}
+
+def _apply_outcome(outcome, current_avg):
+    increase, delta = outcome
+    return increase, 10000 if delta is None else current_avg + delta
+
 def _calculate_first_week_target(current_avg):
     """Calculate target for first week"""
-    if current_avg < 5000:
-        return "500", current_avg + 500
-    elif current_avg < 7500:
-        return "1000", current_avg + 1000
-    elif current_avg < 9000:
-        return "1000", current_avg + 1000
-    elif current_avg < 10000:
-        return "increase to 10000", 10000
-    else:
+    band = bisect_right(_AVG_BANDS, current_avg)
+    if band == _MAINTAIN_BAND:
         return "maintain", current_avg
+    
+    return _apply_outcome(_FIRST_WEEK[band], current_avg)
 
 def _calculate_target_met_matrix(current_avg, previous_increase):
-    """Target met logic - direct translation from PHP algorithm"""
-    
-    # Matrix logic for when target was met
-    if current_avg < 5000:
-        if previous_increase == 250:
-            return "500", current_avg + 500
-        elif previous_increase == 500:
-            return "500", current_avg + 500
-    
-    elif current_avg < 7500:
-        if previous_increase == 250:
-            return "500", current_avg + 500
-        elif previous_increase == 500:
-            return "1000", current_avg + 1000
-        elif previous_increase == 1000:
-            return "1000", current_avg + 1000
-    
-    elif current_avg < 9000:
-        if previous_increase == 250:
-            return "1000", current_avg + 1000
-        elif previous_increase == 500:
-            return "1000", current_avg + 1000
-        elif previous_increase == 1000:
-            return "1000", current_avg + 1000
-    
-    elif current_avg < 10000:
-        if previous_increase == 250:
-            return "500", current_avg + 500
-        elif previous_increase == 500:
-            return "500", current_avg + 500
-        elif previous_increase == 1000:
-            return "500", current_avg + 500
-    
-    elif current_avg >= 10000:
+    """Target met logic - table form of the PHP algorithm"""
+    band = bisect_right(_AVG_BANDS, current_avg)
+    if band == _MAINTAIN_BAND:
         return "maintain", current_avg
     
-    # Fallback (shouldn't reach here with proper data)
-    return "500", current_avg + 500
+    outcome = _MET_TABLE.get((band, previous_increase), _MET_DEFAULT)
+    return _apply_outcome(outcome, current_avg)
 
 def _calculate_target_missed_matrix(current_avg, previous_increase):
-    """Target missed logic - direct translation from PHP algorithm"""
-       
-    # DEBUG LOGGING
-   	# logger.info(f"=== DEBUG _calculate_target_missed_matrix ===")
-    # logger.info(f"current_avg: {current_avg} (type: {type(current_avg)})")
-   	# logger.info(f"previous_increase: {previous_increase} (type: {type(previous_increase)})")
-   	# logger.info(f"previous_increase == 1000: {previous_increase == 1000}")
-    # logger.info(f"previous_increase == 'increase to 10000': {previous_increase == 'increase to 10000'}")
-    
+    """Target missed logic - table form of the PHP algorithm"""
     # Special case: if previous was maintain, return 1000
     if previous_increase == 0:  # "maintain" parsed as 0
         return "1000", current_avg + 1000
     
-    # Matrix logic for when target was missed
-    if current_avg < 5000:
-        if previous_increase == 250:
-            return "250", current_avg + 250
-        elif previous_increase == 500:
-            return "250", current_avg + 250
-        elif previous_increase == 1000:
-            return "500", current_avg + 500
-        elif previous_increase == "increase to 10000":
-            return "1000", current_avg + 1000
-    
-    elif current_avg < 7500:
-        if previous_increase == 250:
-            return "250", current_avg + 250
-        elif previous_increase == 500:
-            return "500", current_avg + 500
-        elif previous_increase == 1000:
-            return "500", current_avg + 500
-        elif previous_increase == "increase to 10000":
-            return "1000", current_avg + 1000
-    
-    elif current_avg < 9000:
-        if previous_increase == 500:
-            return "500", current_avg + 500
-        elif previous_increase == 1000:
-            return "500", current_avg + 500
-        elif previous_increase == "increase to 10000":
-            return "1000", current_avg + 1000
-    
-    elif current_avg < 10000:
-        if previous_increase == 500:
-            return "500", current_avg + 500
-        elif previous_increase == 1000:
-            return "500", current_avg + 500
-        elif previous_increase == "increase to 10000":
-            return "increase to 10000", 10000
-    
-    elif current_avg >= 10000:
+    band = bisect_right(_AVG_BANDS, current_avg)
+    if band == _MAINTAIN_BAND:
         return "maintain", current_avg
     
-    # Fallback (shouldn't reach here with proper data)
-    return "250", current_avg + 250
+    outcome = _MISSED_TABLE.get((band, previous_increase), _MISSED_DEFAULT)
+    return _apply_outcome(outcome, current_avg)
 
 def compute_weekly_target(participant, weekly_average, week_start, week_end, last_goal_data=None):
     """
@@ -246,8 +216,8 @@ def compute_weekly_target(participant, weekly_average, week_start, week_end, las
         "increase": increase_description,
         "average_steps": weekly_average,  # RESTORED: was "step_value"
         "new_target": new_target,
-        "week_start": week_start.strftime("%Y-%m-%d"),
-        "week_end": week_end.strftime("%Y-%m-%d"),
+        "week_start": week_start.isoformat(),
+        "week_end": week_end.isoformat(),
         "previous_target": previous_target,
         "target_was_met": target_was_met if last_goal_data else None
     }
@@ -255,6 +225,9 @@ def compute_weekly_target(participant, weekly_average, week_start, week_end, las
     logger.info(f"Computed goal: {goal_data}")
     return goal_data
     
+# Canonical stored date - anything else goes through strptime
+_ISO_DATE = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+
 def get_step_data_for_week(daily_steps, week_start, week_end):
     """
     Extract and validate step data for a specific week.
@@ -268,21 +241,61 @@ def get_step_data_for_week(daily_steps, week_start, week_end):
         list: Valid step values for the week
     """
     week_steps = []
+    invalid_count = 0
+    
+    # Dates are stored as ISO "YYYY-MM-DD", which sort the same as strings -
+    # compare strings directly instead of parsing every entry
+    start_str = week_start.isoformat()
+    end_str = week_end.isoformat()
     
     for step_entry in daily_steps:
-        try:
-            # Handle both "date" and "dateTime" field names
-            date_str = step_entry.get("date") or step_entry.get("dateTime")
-            step_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-            step_value = int(step_entry["value"])
-            
-            # Validate: correct date range and reasonable step count
-            if week_start <= step_date <= week_end and validate_step_data(step_value):
-                week_steps.append(step_value)
-                
-        except (ValueError, KeyError, TypeError) as e:
-            logger.warning(f"Invalid step entry: {step_entry}, error: {e}")
+        # Handle both "date" and "dateTime" field names
+        date_str = step_entry.get("date") or step_entry.get("dateTime")
+        if not isinstance(date_str, str):
+            invalid_count += 1
+            continue
+        if _ISO_DATE.fullmatch(date_str):
+            if not start_str <= date_str <= end_str:
+                continue
+            # Only the week's own entries are parsed, to reject e.g. 2024-02-30
+            try:
+                date.fromisoformat(date_str)
+            except ValueError:
+                invalid_count += 1
+                continue
+        else:
+            # Hand-edited dates (e.g. not zero-padded) take the strict parse
+            try:
+                step_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+            except ValueError:
+                invalid_count += 1
+                continue
+            if not week_start <= step_date <= week_end:
+                continue
+        
+        # Numbers convert directly; only strings need int()'s own parsing
+        value = step_entry.get("value")
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            step_value = int(value)
+        elif isinstance(value, str):
+            try:
+                step_value = int(value)
+            except ValueError:
+                invalid_count += 1
+                continue
+        else:
+            invalid_count += 1
             continue
+        
+        # Validate: reasonable step count
+        if validate_step_data(step_value, quiet=True):
+            week_steps.append(step_value)
+        else:
+            invalid_count += 1
+    
+    # One summary line rather than a warning per rejected entry
+    if invalid_count:
+        logger.warning(f"Skipped {invalid_count} invalid step entries for week {week_start} to {week_end}")
     
     return week_steps
 
@@ -308,7 +321,7 @@ def run_weekly_algorithm(participant, use_fallback=False, fallback_days_count=No
     
     today = date.today()
     
-    if not is_target_day(participant.start_date):
+    if not is_target_day(participant.start_date, today):
         logger.warning(f"Cannot calculate goals - today is not a target day")
         return None
     
@@ -316,7 +329,9 @@ def run_weekly_algorithm(participant, use_fallback=False, fallback_days_count=No
         daily_steps = participant.daily_steps or []
         
         # Calculate which week we're in since participant start
-        days_since_start = (today - participant.start_date).days
+        # Week math on day ordinals - no timedelta objects per boundary
+        start_ord = participant.start_date.toordinal()
+        days_since_start = today.toordinal() - start_ord
         weeks_since_start = days_since_start // 7
         
         # Still in first week - no complete week to analyze yet
@@ -326,12 +341,12 @@ def run_weekly_algorithm(participant, use_fallback=False, fallback_days_count=No
         
         # Calculate the most recently completed week to analyze
         completed_week_number = weeks_since_start - 1
-        analysis_week_start = participant.start_date + timedelta(days=completed_week_number * 7)
-        analysis_week_end = analysis_week_start + timedelta(days=6)
+        analysis_week_start = date.fromordinal(start_ord + completed_week_number * 7)
+        analysis_week_end = date.fromordinal(start_ord + completed_week_number * 7 + 6)
         
         # Calculate the current week (where we set the goal)
-        target_week_start = participant.start_date + timedelta(days=weeks_since_start * 7)
-        target_week_end = target_week_start + timedelta(days=6)
+        target_week_start = date.fromordinal(start_ord + weeks_since_start * 7)
+        target_week_end = date.fromordinal(start_ord + weeks_since_start * 7 + 6)
         
         logger.info(f"Analyzing week {analysis_week_start} to {analysis_week_end}")
         logger.info(f"Setting goal for week {target_week_start} to {target_week_end}")
@@ -340,26 +355,30 @@ def run_weekly_algorithm(participant, use_fallback=False, fallback_days_count=No
         last_goal_data = None
         if weeks_since_start > 1:  # Only look for previous goal if we're past week 2
             # Find most recent valid target (skip over any previous skipped weeks)
-            previous_week_start = target_week_start - timedelta(days=7)
+            targets = participant.targets or {}
             
-            # Look back up to 10 weeks to find a non-skipped target
-            for lookback in range(10):
-                check_week_start = previous_week_start - timedelta(days=7 * lookback)
-                check_week_key = check_week_start.strftime("%Y-%m-%d")
-                
-                if participant.targets and check_week_key in participant.targets:
-                    candidate_goal = participant.targets[check_week_key]
-                    # Skip over weeks that were skipped due to insufficient data
-                    if candidate_goal.get('calculation_method') != 'skipped_week':
-                        last_goal_data = candidate_goal
-                        logger.info(f"Found previous goal for week {check_week_key}: {last_goal_data}")
-                        break
+            # Look back up to 10 weeks to find a non-skipped target - keys are
+            # ISO dates, so one newest-first pass over the keys in that window
+            cutoff_key = target_week_start.isoformat()
+            oldest_key = date.fromordinal(start_ord + (weeks_since_start - 10) * 7).isoformat()
+            for check_week_key in sorted(targets, reverse=True):
+                if check_week_key >= cutoff_key:
+                    continue
+                if check_week_key < oldest_key:
+                    break
+                candidate_goal = targets[check_week_key]
+                # Skip over weeks that were skipped due to insufficient data
+                if candidate_goal.get('calculation_method') != 'skipped_week':
+                    last_goal_data = candidate_goal
+                    logger.info(f"Found previous goal for week {check_week_key}: {last_goal_data}")
+                    break
             
             if not last_goal_data and weeks_since_start > 1:
                 # TRACK ERROR: Missing previous goal when expected
                 error_msg = f"Missing previous goal data (checked back 10 weeks)"
                 logger.warning(error_msg)
-                _log_status_flag(participant, "target_calculation_fail", error_msg)
+                # Flag is saved with the targets below, or on the insufficient-data return
+                flags_sql = _set_status_flag(participant, "target_calculation_fail", error_msg)
             
             logger.info(f"Using previous goal data: {last_goal_data}")
         else:
@@ -388,8 +407,8 @@ def run_weekly_algorithm(participant, use_fallback=False, fallback_days_count=No
                 last_goal_data=last_goal_data
             )
             
-            # SUCCESS - Clear any previous errors
-            _log_status_flag(participant, "target_calculation_fail")
+            # SUCCESS - Clear any previous errors (saved with the targets below)
+            flags_sql = _set_status_flag(participant, "target_calculation_fail")
             
         else:
             # TRACK ERROR: Insufficient data
@@ -402,9 +421,8 @@ def run_weekly_algorithm(participant, use_fallback=False, fallback_days_count=No
             return None
 
         # Save the goal to participant.targets
-        target_week_key = target_week_start.strftime("%Y-%m-%d")
-        targets = participant.targets or {}
-        targets[target_week_key] = {
+        target_week_key = target_week_start.isoformat()
+        target_entry = {
             "increase": goal_data["increase"],
             "average_steps": goal_data["average_steps"],
             "new_target": goal_data["new_target"]
@@ -412,11 +430,22 @@ def run_weekly_algorithm(participant, use_fallback=False, fallback_days_count=No
         
         # Add metadata for fallback calculations
         if calculation_method == 'partial_data':
-            targets[target_week_key]['calculation_method'] = 'partial_data'
-            targets[target_week_key]['days_with_data'] = fallback_days_count or len(week_steps)
+            target_entry['calculation_method'] = 'partial_data'
+            target_entry['days_with_data'] = fallback_days_count or len(week_steps)
         
+        targets = participant.targets or {}
+        targets[target_week_key] = target_entry
         participant.targets = targets
-        participant.save(update_fields=["targets"])
+        
+        # One UPDATE for the new target and the cleared status flag - the week's
+        # key is set server-side instead of rewriting the whole targets blob
+        Participant.objects.filter(pk=participant.pk).update(
+            targets=RawSQL(
+                "jsonb_set(COALESCE(targets, '{}'::jsonb), %s::text[], %s::jsonb)",
+                [[target_week_key], json.dumps(target_entry)],
+            ),
+            status_flags=flags_sql,
+        )
         
         logger.info(f"Successfully created and saved weekly goal: {goal_data} (method: {calculation_method})")
         return goal_data
@@ -11,6 +11,7 @@ Simulates real-world syncing delays:
 - Includes previous_target field in expected goals
 """
 
+from bisect import bisect_right
 from datetime import date, timedelta
 import json
 import random
@@ -63,7 +64,7 @@ def create_step_data(start_date, step_values):
     """Create step data in Fitbit format: [{"date": "2025-09-03", "value": 2941}]"""
     return [
         {
-            "date": (start_date + timedelta(days=day)).strftime("%Y-%m-%d"),
+            "date": (start_date + timedelta(days=day)).isoformat(),
             "value": steps
         }
         for day, steps in enumerate(step_values)
@@ -72,6 +73,17 @@ def create_step_data(start_date, step_values):
 def calculate_average(step_values):
     return sum(step_values) // len(step_values)
 
+# Average step bands (<5000, <7500, <9000, <10000, 10000+) and the first week
+# goal for each as (increase, step delta) - None means a target of 10000
+AVG_BANDS = (5000, 7500, 9000, 10000)
+FIRST_WEEK_GOALS = (
+    ("500", 500),
+    ("1000", 1000),
+    ("1000", 1000),
+    ("increase to 10000", None),
+    ("maintain", 0),
+)
+
 def predict_goal(average_steps, scenario="first_week", previous_target=None):
     """
     Predict goal with previous_target field included.
@@ -84,16 +96,12 @@ def predict_goal(average_steps, scenario="first_week", previous_target=None):
     Returns:
         dict: Goal data including previous_target field
     """
-    if average_steps < 5000:
-        goal_data = {"increase": "500", "new_target": average_steps + 500, "average_steps": average_steps}
-    elif average_steps < 7500:
-        goal_data = {"increase": "1000", "new_target": average_steps + 1000, "average_steps": average_steps}
-    elif average_steps < 9000:
-        goal_data = {"increase": "1000", "new_target": average_steps + 1000, "average_steps": average_steps}
-    elif average_steps < 10000:
-        goal_data = {"increase": "increase to 10000", "new_target": 10000, "average_steps": average_steps}
+    increase, delta = FIRST_WEEK_GOALS[bisect_right(AVG_BANDS, average_steps)]
+    if delta is None:
+        new_target = 10000
     else:
-        goal_data = {"increase": "maintain", "new_target": average_steps, "average_steps": average_steps}
+        new_target = average_steps + delta
+    goal_data = {"increase": increase, "new_target": new_target, "average_steps": average_steps}
     
     # Add previous_target field (None for first week, actual value for subsequent weeks)
     goal_data["previous_target"] = previous_target
@@ -164,7 +172,7 @@ def generate_test_data(seed=42):
             if complete_days >= 7:
                 week1 = complete_step_values[:7]
                 week1_avg = calculate_average(week1)
-                goal_date_1 = (start_date + timedelta(days=7)).strftime("%Y-%m-%d")
+                goal_date_1 = (start_date + timedelta(days=7)).isoformat()
                 week1_goal = predict_goal(week1_avg, "first_week", previous_target=None)
                 expected_goals[goal_date_1] = week1_goal
                 previous_week_target = week1_goal["new_target"]  # Store for next week
@@ -173,7 +181,7 @@ def generate_test_data(seed=42):
             if complete_days >= 14:
                 week2 = complete_step_values[7:14]
                 week2_avg = calculate_average(week2)
-                goal_date_2 = (start_date + timedelta(days=14)).strftime("%Y-%m-%d")
+                goal_date_2 = (start_date + timedelta(days=14)).isoformat()
                 week2_goal = predict_goal(week2_avg, "second_week", previous_target=previous_week_target)
                 expected_goals[goal_date_2] = week2_goal
 
@@ -188,23 +196,21 @@ def generate_test_data(seed=42):
     return all_test_results
 
 def save_to_csv(all_test_results, filename="step_goals_test_data.csv"):
-    csv_data = []
-    for test_name, results in all_test_results.items():
-        row = {
-            "test_pair": test_name,
-            "actual_days": results["actual_days"],
-            "complete_days": results["complete_days"],
-            "data_json": json.dumps(results["step_data"]),
-            "expected_goals_json": json.dumps(results["expected_goals"])
-        }
-        csv_data.append(row)
     fieldnames = ["test_pair", "actual_days", "complete_days", "data_json", "expected_goals_json"]
     file_exists = os.path.isfile(filename)
     with open(filename, "a", newline="", encoding="utf-8") as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+        writer = csv.writer(csvfile)
         if not file_exists:
-            writer.writeheader()   # Only write header if new file
-        writer.writerows(csv_data)
+            writer.writerow(fieldnames)   # Only write header if new file
+        # Rows are written as they are built, in fieldnames order
+        for test_name, results in all_test_results.items():
+            writer.writerow((
+                test_name,
+                results["actual_days"],
+                results["complete_days"],
+                json.dumps(results["step_data"], separators=(",", ":")),
+                json.dumps(results["expected_goals"], separators=(",", ":")),
+            ))
     return filename
 
 def get_user_input():
@@ -0,0 +1,104 @@
+# goals/tests.py
+from django.test import SimpleTestCase
+
+from goals.targets import calculate_step_increase, _parse_increase_value
+
+# Averages around every band edge plus a spread across the clamped range
+AVERAGES = sorted(
+    set(range(1000, 50001, 250))
+    | {4999, 5000, 5001, 7499, 7500, 7501, 8999, 9000, 9001, 9999, 10000, 10001}
+)
+
+# Stored increase descriptions, including hand-edited and unexpected ones
+INCREASES = [
+    "maintain", "increase to 10000", "250", "500", "1000",
+    "750", "-1", "0", "abc", "", None, 500, ["500"], {"a": 1},
+]
+
+
+def _reference_previous(increase):
+    """Original if/elif parsing of the previous increase"""
+    if increase == "maintain":
+        return 0
+    if increase == "increase to 10000":
+        return "increase to 10000"
+    try:
+        return int(increase)
+    except (ValueError, TypeError):
+        return 0
+
+
+def _reference_first_week(avg):
+    if avg < 5000:
+        return "500", avg + 500
+    elif avg < 9000:
+        return "1000", avg + 1000
+    elif avg < 10000:
+        return "increase to 10000", 10000
+    return "maintain", avg
+
+
+def _reference_met(avg, prev):
+    """Target met branches as translated from the PHP algorithm"""
+    if avg >= 10000:
+        return "maintain", avg
+    if 7500 <= avg < 9000 and prev in (250, 500, 1000):
+        return "1000", avg + 1000
+    if 5000 <= avg < 7500 and prev in (500, 1000):
+        return "1000", avg + 1000
+    return "500", avg + 500
+
+
+def _reference_missed(avg, prev):
+    """Target missed branches as translated from the PHP algorithm"""
+    if prev == 0:
+        return "1000", avg + 1000
+    if avg >= 10000:
+        return "maintain", avg
+    if prev == "increase to 10000":
+        if avg >= 9000:
+            return "increase to 10000", 10000
+        return "1000", avg + 1000
+    if prev == 1000 or (prev == 500 and avg >= 5000):
+        return "500", avg + 500
+    return "250", avg + 250
+
+
+def _reference(avg, last_goal_data, target_was_met):
+    if not last_goal_data:
+        return _reference_first_week(avg)
+    prev = _reference_previous(last_goal_data.get("increase"))
+    if target_was_met:
+        return _reference_met(avg, prev)
+    return _reference_missed(avg, prev)
+
+
+class StepIncreaseTableTests(SimpleTestCase):
+    """The table lookups must match the original PHP-translated branches"""
+
+    def test_first_week_matches_reference(self):
+        for avg in AVERAGES:
+            with self.subTest(avg=avg):
+                self.assertEqual(calculate_step_increase(avg, None), _reference(avg, None, True))
+
+    def test_matrices_match_reference(self):
+        for avg in AVERAGES:
+            for increase in INCREASES:
+                last_goal = {"increase": increase, "new_target": 8000}
+                for met in (True, False):
+                    with self.subTest(avg=avg, increase=increase, met=met):
+                        self.assertEqual(
+                            calculate_step_increase(avg, last_goal, met),
+                            _reference(avg, last_goal, met),
+                        )
+
+    def test_minus_one_is_not_increase_to_10000(self):
+        # "-1" once collided with the int sentinel for "increase to 10000"
+        last_goal = {"increase": "-1"}
+        self.assertEqual(calculate_step_increase(9500, last_goal, False), ("250", 9750))
+        self.assertEqual(calculate_step_increase(6000, last_goal, False), ("250", 6250))
+
+    def test_unparseable_increase_counts_as_maintain(self):
+        for increase in ("abc", None, ["500"], {"a": 1}):
+            with self.subTest(increase=increase):
+                self.assertEqual(_parse_increase_value(increase), 0)
@@ -73,7 +73,7 @@ def calculate_weekly_goals(request, participant_id):
 
 def send_notification_view(request, participant_id):
     try:
-        participant = Participant.objects.get(id=participant_id)
+        participant = Participant.objects.select_related('user').get(id=participant_id)
         
         # Find the most recent goal from today or yesterday
         today = date.today()